@@ -1,6 +1,16 @@
-import csv, io, json, math, os, sys, time
+import csv, io, json, math, os, random, sys, time
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import numpy as np
+except ImportError:  # optional: pure-Python scan below
+    np = None
+try:
+    import orjson
+except ImportError:  # optional: stdlib json below
+    orjson = None
 
 # ------------ Config ------------
 LAT0 = 37.7477
@@ -10,7 +20,14 @@ OUT_PATH = "assets/data/hf_point.json"
 BASE = "https://hfradar.ndbc.noaa.gov/tabdownload.php"
 TIMEOUT = 60
 RETRIES = 5
-RETRY_SLEEP = 6
+RETRY_BASE_MS = 500     # full-jitter backoff: sleep = rand * min(base * 2^i, cap)
+RETRY_CAP_MS = 15000
+BREAKER_TRIP = 6        # consecutive failures of one kind across all queries ~ 2 tiers x 3 tries
+# Skip the run if the last good result covers the current hour and is younger than this
+try:
+    MIN_AGE_MIN = float(os.environ.get("HF_POINT_MIN_AGE_MIN") or 50)
+except ValueError:  # malformed override: keep the default rather than crash at import
+    MIN_AGE_MIN = 50.0
 TIERS = [
     (6, 24),    # hours, boxKm  ← wider box first to catch h_6km
     (12, 24),
@@ -19,100 +36,249 @@ TIERS = [
 ]
 # --------------------------------
 
+# Derived from the fixed target; computed once at import
+_LAT0_RAD = math.radians(LAT0)
+_COS_LAT0 = math.cos(_LAT0_RAD)
+_RAD2DEG = 180.0 / math.pi
+
+# One pooled keep-alive connection for all tiers; retries are driven by fetch_csv
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0))
+_SESSION.headers.update({
+    "Accept": "text/csv", "User-Agent": "Mozilla/5.0",
+    "Accept-Encoding": "gzip, deflate", "Connection": "keep-alive",
+})
+
 def round_down_hour(dt):
     return dt.replace(minute=0, second=0, microsecond=0)
 
+def fmt(dt):
+    # same as dt.strftime("%Y-%m-%d %H:00:00") without the strftime machinery
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:00:00"
+
 def build_bbox(lat0, lon0, box_km):
     dlat = box_km / 111.0
     dlon = box_km / (111.0 * math.cos(math.radians(lat0)))
     return (lat0 - dlat, lon0 - dlon, lat0 + dlat, lon0 + dlon)
 
-def haversine_m(lat1, lon1, lat2, lon2):
-    R = 6371000.0
-    p1 = math.radians(lat1); p2 = math.radians(lat2)
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dlon/2)**2
-    return 2*R*math.asin(math.sqrt(a))
+# Target and boxes are fixed: bbox and its query fields are constants per box size
+_BBOX_BY_BOX = {box_km: build_bbox(LAT0, LON0, box_km) for _, box_km in TIERS}
+_PARAMS_BY_BOX = {
+    box_km: {"lat": f"{lat1}", "lng": f"{lon1}", "lat2": f"{lat2}", "lng2": f"{lon2}",
+             "uom": UOM, "fmt": "csv"}
+    for box_km, (lat1, lon1, lat2, lon2) in _BBOX_BY_BOX.items()
+}
+
+def find_nearest(lats, lons):
+    """Index of the cell nearest (LAT0, LON0), pure Python, single pass."""
+    best_idx, best_d2 = -1, math.inf
+    for i, lat in enumerate(lats):
+        dlat = lat - LAT0
+        dlat2 = dlat*dlat
+        if dlat2 >= best_d2:
+            continue  # dlon^2 only adds, so latitude alone rejects it
+        dlon = (lons[i] - LON0) * _COS_LAT0
+        d2 = dlat2 + dlon*dlon
+        if d2 < best_d2:
+            best_idx, best_d2 = i, d2
+    return best_idx
+
+def backoff_s(i):
+    # AWS "full jitter": uniform in [0, min(base * 2^i, cap)]
+    return random.random() * min(RETRY_BASE_MS * (2 ** i), RETRY_CAP_MS) / 1000.0
+
+def retry_after_s(r):
+    # Retry-After is either delta-seconds or an HTTP date
+    val = r.headers.get("Retry-After")
+    if not val:
+        return 0.0
+    try:
+        return max(0.0, float(val))
+    except ValueError:
+        pass
+    try:
+        then = parsedate_to_datetime(val)
+    except (TypeError, ValueError):
+        return 0.0
+    if then.tzinfo is None:
+        then = then.replace(tzinfo=timezone.utc)
+    return max(0.0, (then - datetime.now(timezone.utc)).total_seconds())
+
+def nearest_idx(lats, lons):
+    """Index of the cell nearest (LAT0, LON0)."""
+    if np is None:
+        return find_nearest(lats, lons)
+    # Equirectangular: over a <40 km box the error vs haversine is sub-meter,
+    # and ordering (argmin) is all we need.
+    la = np.asarray(lats); lo = np.asarray(lons)
+    return int(np.argmin((la - LAT0)**2 + (_COS_LAT0 * (lo - LON0))**2))
+
+def iter_body(r):
+    # Yield raw byte lines as they arrive (no charset detection / decode);
+    # releases the connection once drained
+    with r:
+        yield from r.iter_lines()
+
+class UpstreamDownError(Exception):
+    """Raised once the circuit breaker trips; stop probing further tiers."""
+
+# Shared by all tier queries of a run. Counted: 5xx, 429, timeouts/connection errors and any
+# other RequestException (retrying can't tell it apart from a flaky host). Only a 200
+# closes the breaker again; other 4xx end that query and leave the counters alone.
+_BREAKER = {"5xx": 0, "429": 0, "timeout": 0, "error": 0}
+
+def breaker_check():
+    if max(_BREAKER.values()) >= BREAKER_TRIP:
+        raise UpstreamDownError(f"upstream down: {_BREAKER}")
+
+def breaker_record(kind=None):
+    # kind is a _BREAKER key; None records a healthy (200) response
+    if kind is None:
+        for k in _BREAKER:
+            _BREAKER[k] = 0
+    else:
+        _BREAKER[kind] += 1
+    breaker_check()
 
 def fetch_csv(params):
-    last_text = ""
+    """Returns (status, parsed columns)."""
+    last = (0, parse_rows(()))
     for i in range(RETRIES + 1):
+        breaker_check()  # an earlier tier's query may already have tripped it
         try:
-            r = requests.get(BASE, params=params, timeout=TIMEOUT,
-                             headers={"Accept": "text/csv", "User-Agent": "Mozilla/5.0"})
-            if r.status_code == 200 and r.text.strip():
-                return r.text
-            if r.status_code >= 500 or r.status_code == 429:
-                time.sleep(RETRY_SLEEP*(i+1)); continue
-            last_text = r.text
-            break
+            r = _SESSION.get(BASE, params=params, timeout=TIMEOUT, stream=True)
+            # drain + parse inside the try, so a body dropped mid-stream is retried like a failed GET
+            cols = parse_rows(iter_body(r)) if r.status_code == 200 else None
+        except (requests.Timeout, requests.ConnectionError):
+            breaker_record("timeout")
+            time.sleep(backoff_s(i)); continue
         except requests.RequestException:
-            time.sleep(RETRY_SLEEP*(i+1))
-            continue
-    return last_text
-
-def parse_rows(text):
-    if not text:
-        return []
-    # Keep only non-empty, non-comment lines
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip() and not ln.strip().startswith("#")]
-    if len(lines) <= 1:
-        return []
-    rdr = csv.reader(lines)
+            breaker_record("error")
+            time.sleep(backoff_s(i)); continue
+        if r.status_code >= 500:
+            r.close()
+            breaker_record("5xx")
+            time.sleep(backoff_s(i)); continue
+        if r.status_code == 200:
+            breaker_record()
+            return 200, cols
+        r.close()
+        if r.status_code == 429:
+            breaker_record("429")
+            # honour Retry-After, but never past the backoff cap
+            time.sleep(max(min(retry_after_s(r), RETRY_CAP_MS / 1000.0), backoff_s(i))); continue
+        last = (r.status_code, parse_rows(()))
+        break
+    return last
+
+def parse_rows(lines):
+    """Parses CSV byte lines into parallel lists (times, lats, lons, us, vs), in one pass."""
+    times, lats, lons, us, vs = [], [], [], [], []
+    # Keep only non-empty, non-comment lines; filter on bytes, decode only survivors
+    data = (ln.decode("ascii", "replace") for ln in (raw.strip() for raw in lines)
+            if ln and ln[:1] != b"#")
+    rdr = csv.reader(data)
     header = next(rdr, None)
-    rows = []
+    # No per-row dict/tuple: floats go straight into the column lists
+    add_t, add_la, add_lo, add_u, add_v = times.append, lats.append, lons.append, us.append, vs.append
     for row in rdr:
         if len(row) < 5: continue
-        t, la, lo, u, v = row[:5]
         try:
-            rows.append({"time": t, "lat": float(la), "lon": float(lo), "u": float(u), "v": float(v)})
+            la, lo, u, v = float(row[1]), float(row[2]), float(row[3]), float(row[4])
         except ValueError:
-            pass
-    return rows
+            continue
+        add_t(row[0]); add_la(la); add_lo(lo); add_u(u); add_v(v)
+    return times, lats, lons, us, vs
+
+def fetch_window(params):
+    """Fetch + parse one query. Returns (url, parsed columns)."""
+    url = requests.Request('GET', BASE, params=params).prepare().url
+    status, cols = fetch_csv(params)
+    return url, cols
 
 def write_json(obj):
     os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2)
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, indent=2).encode("utf-8")
+    # write a sibling temp file and swap it in, so a killed run never leaves a truncated file
+    tmp = OUT_PATH + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, OUT_PATH)
+
+def touch_existing():
+    # keep the previous payload without re-parsing/re-serializing it
+    os.utime(OUT_PATH, None)
 
 def load_existing():
+    # a missing, corrupt or non-object file all mean "nothing usable to keep"
     try:
         with open(OUT_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
         return None
+    return data if isinstance(data, dict) else None
+
+def is_fresh(existing, now):
+    # A good (n == 1) result whose window already ends at this hour, written less than
+    # MIN_AGE_MIN ago, can't be missing a newer radar frame
+    if not existing or existing.get("n", 0) != 1 or not existing.get("generated_at"):
+        return False
+    if existing.get("to") != fmt(round_down_hour(now)):
+        return False  # a new hour has started since: its frame may be available
+    try:
+        then = datetime.fromisoformat(existing["generated_at"])
+    except ValueError:
+        return False
+    if then.tzinfo is None:
+        then = then.replace(tzinfo=timezone.utc)
+    return now - then < timedelta(minutes=MIN_AGE_MIN)
 
 def main():
     now = datetime.now(timezone.utc)
+    existing = load_existing()
+    if is_fresh(existing, now):
+        touch_existing()
+        return
     end = round_down_hour(now)
-    generated_at = datetime.now(timezone.utc).isoformat()
+    generated_at = now.isoformat()
+
+    # Tiers run in order and stop at the first with rows. A tier reusing an earlier
+    # tier's box only asks for the hours that tier didn't cover: those came back empty.
+    to_str = fmt(end)
+    covered = {}  # box_km -> start of the span already fetched (without rows) for that box
 
-    # try each tier until we find data
-    last_debug = {}
+    # walk tiers smallest-first; failure paths leave result as None
+    result = None
+    last_debug = None
     for hours, box_km in TIERS:
         start = end - timedelta(hours=hours)
-        from_str = start.strftime("%Y-%m-%d %H:00:00")
-        to_str   = end.strftime("%Y-%m-%d %H:00:00")
-
-        lat1, lon1, lat2, lon2 = build_bbox(LAT0, LON0, box_km)
-        params = {
-            "from": from_str, "to": to_str,
-            "lat": f"{lat1}", "lng": f"{lon1}",
-            "lat2": f"{lat2}", "lng2": f"{lon2}",
-            "uom": UOM, "fmt": "csv"
-        }
-        url_preview = requests.Request('GET', BASE, params=params).prepare().url
-        csv_text = fetch_csv(params)
-        rows = parse_rows(csv_text)
+        from_str = fmt(start)
+        q_end = covered.get(box_km, end)
+        if start >= q_end:
+            continue  # whole window already fetched and empty
+        # "from"/"to" first so the query string keeps its order
+        params = {"from": from_str, "to": fmt(q_end), **_PARAMS_BY_BOX[box_km]}
+        try:
+            url_preview, (times, lats, lons, us, vs) = fetch_window(params)
+        except UpstreamDownError as e:
+            # don't walk the remaining tiers against a dead host
+            last_debug = {
+                "target": {"lat": LAT0, "lon": LON0},
+                "uom": UOM, "n": 0, "error": str(e),
+            }
+            break
+        covered[box_km] = start
 
-        if rows:
+        if lats:
             # nearest single grid cell (your requirement)
-            nearest = min(rows, key=lambda r: haversine_m(LAT0, LON0, r["lat"], r["lon"]))
-            u, v = nearest["u"], nearest["v"]
+            i = nearest_idx(lats, lons)
+            u, v = us[i], vs[i]
+            nearest = {"time": times[i], "lat": lats[i], "lon": lons[i], "u": u, "v": v}
             speed = math.hypot(u, v)
-            bearing = math.degrees(math.atan2(u, v)); 
-            if bearing < 0: bearing += 360.0
+            bearing = (math.atan2(u, v) * _RAD2DEG) % 360.0  # float % wraps negatives
 
             result = {
                 "target": {"lat": LAT0, "lon": LON0},
@@ -125,32 +291,29 @@ def main():
                 "tier_used": {"hours": hours, "boxKm": box_km}
             }
             result["generated_at"] = generated_at
-            write_json(result)
-            return
-        else:
-            last_debug = {
-                "target": {"lat": LAT0, "lon": LON0},
-                "from": from_str, "to": to_str,
-                "hours": hours, "boxKm": box_km,
-                "uom": UOM, "n": 0,
-                "error": "no rows",
-                "source_url": url_preview
-            }
-
-    # If no tiers produced data, write the last debug payload (with URL) or keep last good file
-    existing = load_existing()
-    last_debug["generated_at"] = generated_at
-    if last_debug:
-        write_json(last_debug)  # includes source_url, hours, boxKm
-    elif existing:
-        existing["generated_at"] = generated_at
-        write_json(existing)
-    else:
-        write_json({
+            break
+        last_debug = {
             "target": {"lat": LAT0, "lon": LON0},
-            "uom": UOM, "n": 0, "error": "no data",
-            "generated_at": generated_at
-        })
+            "from": from_str, "to": to_str,
+            "hours": hours, "boxKm": box_km,
+            "uom": UOM, "n": 0,
+            "error": "no rows",
+            "source_url": url_preview
+        }
+
+    # New data, else keep the last file as-is, else write the last debug payload (with URL)
+    if result:
+        write_json(result)
+        return
+    if existing is not None:
+        touch_existing()
+        return
+    fallback = last_debug or {
+        "target": {"lat": LAT0, "lon": LON0},
+        "uom": UOM, "n": 0, "error": "no data",
+    }
+    fallback["generated_at"] = generated_at
+    write_json(fallback)
 
 if __name__ == "__main__":
     main()